@@ -7,6 +7,9 @@ import numpy as np
 from algorithms.kmeans import KMeans
 from utils.plotting import get_colors
 
+# Rows of X processed at once when updating U, so that the (CHUNK_SIZE, K) intermediates stay in cache
+CHUNK_SIZE = 1024
+
 
 class FuzzyCMeans(KMeans):
     def __init__(self, m: int, epsilon=0.01, **kwargs):
@@ -16,18 +19,36 @@ class FuzzyCMeans(KMeans):
         """
         self.m = m
         self.epsilon = epsilon
+        self._eps2 = epsilon ** 2
+
+        self.u = None
+        self._u_pow_m = None
+        self._X_sq_norms = None
 
         super().__init__(**kwargs)
 
+    def fit(self, X: np.ndarray, precomputed_distances: np.ndarray = None):
+        # Single precision contiguous data halves the memory traffic of the distance and membership updates
+        super().fit(np.ascontiguousarray(X, dtype=np.float32), precomputed_distances=precomputed_distances)
+
     def _init_centroids(self):
         """Initialize centroids (V) and c-partition matrix U"""
         super()._init_centroids()
+        self.centroids = np.ascontiguousarray(self.centroids, dtype=np.float32)
         self._init_u()
+        # X does not change during the fit, so its squared norms are computed only once
+        self._X_sq_norms = (self.X ** 2).sum(axis=1)
 
     def _init_u(self):
         """Initialize matrix U (K, n) with random values such that each column adds up to 1."""
-        u = np.random.random(size=(self.K, self.X.shape[0]))
-        self.u = u / u.sum(axis=0)[None, :]
+        # Each column is sampled uniformly from the simplex, so no normalization pass is needed
+        u = np.random.dirichlet(np.ones(self.K), size=self.X.shape[0]).T
+        self.u = np.ascontiguousarray(u, dtype=np.float32)
+        self._cache_u_pow_m()
+
+    def _cache_u_pow_m(self):
+        """Store U ^ m, shared by the updates of V and U and the loss until U changes again."""
+        self._u_pow_m = self.u * self.u if self.m == 2 else self.u ** self.m
 
     def _compute_centroids(self, *args):
         """
@@ -35,52 +56,80 @@ class FuzzyCMeans(KMeans):
         :param args: Ignored for inheritance interface design.
         """
         self._update_v()
-        logging.debug(f'({self.it:3}/{self.max_it}) Loss after updating V: {self._loss():.6f}')
+        # The loss is a full pass over the data, only compute it if it is going to be logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('(%3d/%d) Loss after updating V: %.6f', self.it, self.max_it, self._loss())
 
         self._update_u()
-        logging.debug(f'({self.it:3}/{self.max_it}) Loss after updating U: {self._loss():.6f}')
+        self._cache_u_pow_m()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('(%3d/%d) Loss after updating U: %.6f', self.it, self.max_it, self._loss())
 
     def _update_v(self):
         """
         Update centroids (centers of gravity) V.
         v_k = ∑_i ((U_ki ^ m) * x_i) / ∑_i (U_ki ^ m)
         """
-        u_pow_m = self.u ** self.m
-        n_term = u_pow_m @ self.X
-        d_term = u_pow_m.sum(axis=1, keepdims=True)
-        self.centroids = n_term / d_term
+        centroids = np.einsum('kn,nd->kd', self._u_pow_m, self.X, optimize=True)
+        centroids /= self._u_pow_m.sum(axis=1, keepdims=True)
+        self.centroids = centroids
 
     def _loss(self):
         """
+        Objective function minimized by FCM.
+        J = ∑_i ∑_k (U_ki ^ m) * ||x_i - v_k|| ^ 2
+        :return: Loss value with the current U and V.
+        """
+        return float((self._u_pow_m.T * self._sq_dists()).sum())
 
-        :return:
+    def _sq_dists(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        Squared euclidean distances between observations and centroids using the identity
+        ||x - v|| ^ 2 = ||x|| ^ 2 + ||v|| ^ 2 - 2 * x · v, so the bulk of the work is a single matrix product.
+        :param start: First observation (row of X) to compute.
+        :param stop: Observation where to stop (exclusive), None to compute until the end.
+        :return: Matrix of shape (#observations, K).
         """
-        # TODO: Vectorize
-        res = 0
-        for i in range(self.X.shape[0]):
-            for k in range(self.K):
-                res += (self.u[k, i] ** self.m) * np.linalg.norm(self.X[i] - self.centroids[k]) ** 2
-        return res
+        c_sq_norms = (self.centroids ** 2).sum(axis=1)
+        # Accumulate in place over the product to avoid (#observations, K) temporaries
+        sq_distances = self.X[start:stop] @ self.centroids.T
+        sq_distances *= -2
+        sq_distances += self._X_sq_norms[start:stop, None]
+        sq_distances += c_sq_norms[None, :]
+        return np.maximum(sq_distances, 0, out=sq_distances)
 
     def _update_u(self):
-        # TODO: Vectorize
-        for k in range(self.K):
-            for i in range(self.X.shape[0]):
-                u_ki = 0
-                num = np.linalg.norm(self.X[i, :] - self.centroids[k])
-                for j in range(self.u.shape[0]):
-                    den = np.linalg.norm(self.X[i, :] - self.centroids[j])
-                    u_ki += (num / den) ** (2 / (self.m - 1))
-                u_ki **= -1
-                self.u[k, i] = u_ki
-
-        self.u = self.u / self.u.sum(axis=0)[None, :]
+        """
+        Update c-partition matrix U.
+        u_ki = 1 / ∑_j (||x_i - v_k|| / ||x_i - v_j||) ^ (2 / (m - 1))
+        """
+        self._u_pow_m = None
+
+        n = self.X.shape[0]
+        self.u = np.empty((self.K, n), dtype=self.X.dtype)
+
+        for start in range(0, n, CHUNK_SIZE):
+            stop = start + CHUNK_SIZE
+
+            # U is a softmax of -log(||x_i - v_k|| ^ 2) / (m - 1) over the centroids, which stays stable for
+            # points lying on top of a centroid (they get all the membership)
+            logits = self._sq_dists(start, stop)
+            logits += np.finfo(logits.dtype).tiny
+            np.log(logits, out=logits)
+            logits *= -1 / (self.m - 1)
+
+            # Softmax in place, dividing by the row sums so that each column of U adds up to 1 in float32 too
+            logits -= logits.max(axis=1, keepdims=True)
+            np.exp(logits, out=logits)
+            logits /= logits.sum(axis=1, keepdims=True)
+            self.u[:, start:stop] = logits.T
 
     def _check_convergence(self, previous_centroids):
         if self.it >= self.max_it:
             return True
         if previous_centroids is not None:
-            return np.linalg.norm(self.centroids - previous_centroids, ord=1) < self.epsilon
+            # Compare the largest squared centroid shift to epsilon ^ 2 to avoid the square root
+            return ((self.centroids - previous_centroids) ** 2).sum(axis=1).max() < self._eps2
         return False
 
     def _display_iteration(self, X, nearest_idx):
@@ -101,8 +150,7 @@ class FuzzyCMeans(KMeans):
             plt.show()
         else:
             directory = os.path.join(self.fig_save_path, self.__class__.__name__)
-            if not os.path.exists(directory):
-                os.mkdir(directory)
+            os.makedirs(directory, exist_ok=True)
             plt.savefig(os.path.join(directory, f'{self.name}_K{self.K}_{self.it}.png'))
         plt.close()
 
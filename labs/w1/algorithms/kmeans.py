@@ -52,11 +52,17 @@ class KMeans:
 
         self.X = None
         self.centroids = None
+        self._init_idx = None
         self.nearest = None
 
         self.colors = get_colors(K)
 
-    def fit(self, X: np.ndarray):
+    def fit(self, X: np.ndarray, precomputed_distances: np.ndarray = None):
+        """
+        Fit the model with provided data.
+        :param X: 2D data array of size (rows, features).
+        :param precomputed_distances: Optional point-wise distances matrix of X, of size (rows, rows).
+        """
         np.random.seed(self.seed)
         self.X = X
         self._init_centroids()
@@ -65,7 +71,11 @@ class KMeans:
         previous_centroids = None
 
         while True:
-            distances = self._calculate_distances(X)
+            if self.it == 0 and precomputed_distances is not None:
+                # Initial centroids are observations of X, so their distances are already known
+                distances = precomputed_distances[self._init_idx, :]
+            else:
+                distances = self._calculate_distances(X)
             _, self.nearest, nearest_idx = self._get_nearest(X, distances)
 
             self._display_iteration(X, nearest_idx)
@@ -73,7 +83,8 @@ class KMeans:
             self._compute_centroids()
 
             # Check convergence
-            logging.info(f'{self.it:3}/{self.max_it} Loss: {self._loss()}')
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info('%3d/%d Loss: %s', self.it, self.max_it, self._loss())
 
             self.it += 1
             if self._check_convergence(previous_centroids):
@@ -95,13 +106,14 @@ class KMeans:
 
         return classes
 
-    def fit_predict(self, X: np.ndarray) -> List[int]:
+    def fit_predict(self, X: np.ndarray, precomputed_distances: np.ndarray = None) -> List[int]:
         """
         Fit the model with provided data and return their assigned clusters.
         :param X: 2D data array of size (rows, features).
+        :param precomputed_distances: Optional point-wise distances matrix of X, of size (rows, rows).
         :return: Cluster indexes assigned to each row of X.
         """
-        self.fit(X)
+        self.fit(X, precomputed_distances=precomputed_distances)
         return self.predict(X)
 
     def compute_point_wise_distances(self, X):
@@ -119,8 +131,8 @@ class KMeans:
     def _init_centroids(self):
         """Initialize centroids"""
         # self.centroids = np.random.random(size=(self.K, self.X.shape[1]))
-        idx = np.random.choice(range(self.X.shape[0]), size=self.K, replace=False)
-        self.centroids = self.X[idx, :]
+        self._init_idx = np.random.choice(range(self.X.shape[0]), size=self.K, replace=False)
+        self.centroids = self.X[self._init_idx, :]
 
     def _calculate_distances(self, X: np.ndarray) -> np.ndarray:
         """
@@ -247,7 +259,6 @@ class KMeans:
             plt.show()
         else:
             directory = os.path.join(self.fig_save_path, self.__class__.__name__)
-            if not os.path.exists(directory):
-                os.mkdir(directory)
+            os.makedirs(directory, exist_ok=True)
             plt.savefig(os.path.join(directory, f'{self.name}_K{self.K}_{self.it}.png'))
         plt.close()
@@ -12,11 +12,11 @@ class KPrototypes(KMeans):
 
         super().__init__(**kwargs)
 
-    def fit(self, X: np.ndarray, max_it=20):
+    def fit(self, X: np.ndarray, max_it=20, precomputed_distances: np.ndarray = None):
         self.mask = np.zeros(X.shape[1], dtype=bool)
         self.mask[self.cat_idx] = True
 
-        super().fit(X)
+        super().fit(X, precomputed_distances=precomputed_distances)
 
     def compute_point_wise_distances(self, X):
         self.mask = np.zeros(X.shape[1], dtype=bool)
@@ -2,8 +2,10 @@ import argparse
 import logging
 import os
 from datetime import datetime
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
 
@@ -23,32 +25,42 @@ metrics = {
 }
 
 
+@lru_cache(maxsize=None)
+def load_dataset(x_file: str, y_file: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Read a preprocessed dataset. Results are cached, since the same files are used by several experiments.
+    :param x_file: CSV file name with the observations inside ./datasets folder.
+    :param y_file: CSV file name with the labels inside ./datasets folder.
+    :return: Tuple with X and Y data frames.
+    """
+    X = pd.read_csv(os.path.join('datasets', x_file))
+    Y = pd.read_csv(os.path.join('datasets', y_file), header=None)
+    return X, Y
+
+
 def optimize_dict_to_table(results):
-    table = '\n| K | Score |\n :---: | :---:'
-    for x in results:
-        table += f'\n {x["k"]} | {x["score"]:.6f}'
-    return table
+    lines = ['', '| K | Score |', ' :---: | :---:']
+    lines += [f' {x["k"]} | {x["score"]:.6f}' for x in results]
+    return '\n'.join(lines)
 
 
 def eval_dict_to_table(res):
-    table = '\n| Metric | Score |\n :---: | :---:'
-    for metric, score in res.items():
-        if metric != 'contingency_matrix':
-            table += f'\n {metric} | {score:.6f}'
+    lines = ['', '| Metric | Score |', ' :---: | :---:']
+    lines += [f' {metric} | {score:.6f}' for metric, score in res.items() if metric != 'contingency_matrix']
 
     if 'contingency_matrix' in res:
-        table += '\nContingency Matrix\n'
-        rows, cols = res['contingency_matrix'].shape[0], res['contingency_matrix'].shape[1]
-        table += '\n|' + ' |' * cols + '\n ' + ':---: |' * cols
-        for i in range(rows):
-            row = ' | '.join(list(map(str, res['contingency_matrix'][i, :])))
-            table += '\n' + row
+        contingency_matrix = res['contingency_matrix']
+        cols = contingency_matrix.shape[1]
+        lines += ['Contingency Matrix', '', '|' + ' |' * cols, ' ' + ':---: |' * cols]
+        # Convert the whole matrix to Python ints at once instead of element by element
+        lines += [' | '.join(map(str, row)) for row in contingency_matrix.tolist()]
 
-    return table
+    return '\n'.join(lines)
 
 
-def generate_results(X, Y, results, results_to_save, fuzzy_eval=False, precomputed_distances=None):
-    results_to_save += f'Optimization of K with silhouette_score:\n{optimize_dict_to_table(results)}\n'
+def generate_results(X, Y, results, results_to_save: List[str], fuzzy_eval=False, precomputed_distances=None):
+    """Append the optimization and evaluation tables of the experiment to the `results_to_save` report parts."""
+    results_to_save.append(f'Optimization of K with silhouette_score:\n{optimize_dict_to_table(results)}\n')
 
     # Unsupervised validation with the obtained best K
     if fuzzy_eval:
@@ -58,8 +70,8 @@ def generate_results(X, Y, results, results_to_save, fuzzy_eval=False, precomput
                                              labels=results[0]['prediction'],
                                              precomputed_distances=precomputed_distances)
 
-    results_to_save += f'Unsupervised evaluation of the clustering with the best K ({results[0]["k"]}):\n'
-    results_to_save += f'{eval_dict_to_table(res)}\n'
+    results_to_save.append(f'Unsupervised evaluation of the clustering with the best K ({results[0]["k"]}):\n')
+    results_to_save.append(f'{eval_dict_to_table(res)}\n')
 
     # With k = n_classes
     n_classes = len(Y[Y.columns[0]].unique())
@@ -70,24 +82,21 @@ def generate_results(X, Y, results, results_to_save, fuzzy_eval=False, precomput
     else:
         res = evaluate.evaluate_supervised(labels_true=Y.values.flatten(), labels_pred=real_k['prediction'])
 
-    results_to_save += f'Supervised evaluation of the clustering with K = #classes({real_k["k"]}):\n'
-    results_to_save += f'{eval_dict_to_table(res)}\n'
-
-    return results_to_save
+    results_to_save.append(f'Supervised evaluation of the clustering with K = #classes({real_k["k"]}):\n')
+    results_to_save.append(f'{eval_dict_to_table(res)}\n')
 
 
 def run_agglomerative(paths: List[Dict[str, str]], params):
     message = 'Running Agglomerative experiments'
     print(message + '...')
     logging.info(message)
-    results_to_save = '### Agglomerative Clustering experiments results\n'
-    results_to_save += 'Default parameters except for the number of clusters, affinity and linkage.\n'
-    results_to_save += 'We set #clusters as #classes.\n'
+    results_to_save = ['### Agglomerative Clustering experiments results\n',
+                       'Default parameters except for the number of clusters, affinity and linkage.\n',
+                       'We set #clusters as #classes.\n']
 
     for path in paths:
-        results_to_save += f'{path["name"]} dataset\n'
-        X = pd.read_csv(os.path.join('datasets', path['X']))
-        Y = pd.read_csv(os.path.join('datasets', path['Y']), header=None)
+        results_to_save.append(f'{path["name"]} dataset\n')
+        X, Y = load_dataset(path['X'], path['Y'])
 
         # Instead of optimizing the number of clusters, this time we are going to test other parameter as suggested
         # in the assignment. In particular, we are going to experiment with different affinities and linkages
@@ -95,16 +104,16 @@ def run_agglomerative(paths: List[Dict[str, str]], params):
         results = agglomerative_clustering(X=X, K=n_classes, name=path['name'], fig_save_path=params.output_path)
 
         for result in results:
-            results_to_save += f'Results with affinity {result["affinity"]} and linkage {result["linkage"]}\n'
+            results_to_save.append(f'Results with affinity {result["affinity"]} and linkage {result["linkage"]}\n')
             # Supervised evaluation (we are using k = # classes)
             res = evaluate.evaluate_supervised(labels_true=Y.values.flatten(), labels_pred=result['prediction'])
-            results_to_save += f'Supervised evaluation:\n{eval_dict_to_table(res)}\n'
+            results_to_save.append(f'Supervised evaluation:\n{eval_dict_to_table(res)}\n')
             # Unsupervised
             res = evaluate.evaluate_unsupervised(X=X, labels=result['prediction'])
-            results_to_save += f'Unsupervised evaluation:\n{eval_dict_to_table(res)}\n'
+            results_to_save.append(f'Unsupervised evaluation:\n{eval_dict_to_table(res)}\n')
 
     with open(os.path.join(params.output_path, 'results.md'), 'a') as f:
-        f.write(results_to_save)
+        f.write(''.join(results_to_save))
 
 
 def run_kmeans(paths: List[Dict[str, str]], params):
@@ -112,13 +121,12 @@ def run_kmeans(paths: List[Dict[str, str]], params):
     print(message + '...')
     logging.info(message)
 
-    results_to_save = '### K-Means experiments results\n'
-    results_to_save += 'Except K, the other parameters are the default ones (eg. euclidean distance)\n'
+    results_to_save = ['### K-Means experiments results\n',
+                       'Except K, the other parameters are the default ones (eg. euclidean distance)\n']
 
     for path in paths:
-        results_to_save += f'{path["name"]} dataset\n'
-        X = pd.read_csv(os.path.join('datasets', path['X']))
-        Y = pd.read_csv(os.path.join('datasets', path['Y']), header=None)
+        results_to_save.append(f'{path["name"]} dataset\n')
+        X, Y = load_dataset(path['X'], path['Y'])
 
         # Optimization of K
 
@@ -131,10 +139,10 @@ def run_kmeans(paths: List[Dict[str, str]], params):
                            k_values=list(range(2, 15)),
                            goal='minimize')
 
-        results_to_save = generate_results(X, Y, results, results_to_save)
+        generate_results(X, Y, results, results_to_save)
 
     with open(os.path.join(params.output_path, 'results.md'), 'a') as f:
-        f.write(results_to_save)
+        f.write(''.join(results_to_save))
 
 
 # TODO: isn't run_kmodes extremely slow?
@@ -143,13 +151,12 @@ def run_kmodes(paths: List[Dict[str, str]], params):
     print(message + '...')
     logging.info(message)
 
-    results_to_save = '### K-Modes experiments results\n'
-    results_to_save += 'Except K, the other parameters are the default ones\n'
+    results_to_save = ['### K-Modes experiments results\n',
+                       'Except K, the other parameters are the default ones\n']
 
     for path in paths:
-        results_to_save += f'{path["name"]} dataset\n'
-        X = pd.read_csv(os.path.join('datasets', path['X']))
-        Y = pd.read_csv(os.path.join('datasets', path['Y']), header=None)
+        results_to_save.append(f'{path["name"]} dataset\n')
+        X, Y = load_dataset(path['X'], path['Y'])
 
         # Optimization of K
 
@@ -166,18 +173,15 @@ def run_kmodes(paths: List[Dict[str, str]], params):
                            goal='maximize',
                            precomputed_distances=precomputed_distances)
 
-        results_to_save = generate_results(X, Y, results, results_to_save, precomputed_distances=precomputed_distances)
+        generate_results(X, Y, results, results_to_save, precomputed_distances=precomputed_distances)
 
     with open(os.path.join(params.output_path, 'results.md'), 'a') as f:
-        f.write(results_to_save)
+        f.write(''.join(results_to_save))
 
 
 def get_cat_idx(df):
-    cat_idx = []
-    for index, (name, values) in enumerate(df.iteritems()):
-        if isinstance(values[0], str):
-            cat_idx.append(index)
-    return cat_idx
+    """Indexes of the categorical (object dtype, read as strings) columns of the data frame."""
+    return np.flatnonzero((df.dtypes == object).values).tolist()
 
 
 def run_kprototypes(paths: List[Dict[str, str]], params):
@@ -185,11 +189,10 @@ def run_kprototypes(paths: List[Dict[str, str]], params):
     print(message + '...')
     logging.info(message)
 
-    results_to_save = 'K-Prototypes experiments results\n'
+    results_to_save = ['K-Prototypes experiments results\n']
     for path in paths:
-        results_to_save += f'{path["name"]} dataset\n'
-        X = pd.read_csv(os.path.join('datasets', path['X']))
-        Y = pd.read_csv(os.path.join('datasets', path['Y']), header=None)
+        results_to_save.append(f'{path["name"]} dataset\n')
+        X, Y = load_dataset(path['X'], path['Y'])
 
         # Optimization of K
 
@@ -206,10 +209,10 @@ def run_kprototypes(paths: List[Dict[str, str]], params):
                            goal='minimize',
                            precomputed_distances=precomputed_distances)
 
-        results_to_save = generate_results(X, Y, results, results_to_save, precomputed_distances=precomputed_distances)
+        generate_results(X, Y, results, results_to_save, precomputed_distances=precomputed_distances)
 
     with open(os.path.join(params.output_path, 'results.md'), 'a') as f:
-        f.write(results_to_save)
+        f.write(''.join(results_to_save))
 
 
 def run_fcm(paths: List[Dict[str, str]], params):
@@ -217,12 +220,11 @@ def run_fcm(paths: List[Dict[str, str]], params):
     print(message)
     logging.info(message)
 
-    results_to_save = '### Fuzzy C-Means experiments results\n'
-    results_to_save += 'Except *K* and *m* the other parameters are the default ones (eg. euclidean distance)\n'
+    results_to_save = ['### Fuzzy C-Means experiments results\n',
+                       'Except *K* and *m* the other parameters are the default ones (eg. euclidean distance)\n']
 
     for path in paths:
-        X = pd.read_csv(os.path.join('datasets', path['X']))
-        Y = pd.read_csv(os.path.join('datasets', path['Y']), header=None)
+        X, Y = load_dataset(path['X'], path['Y'])
 
         alg_params = {'name': path['name'], 'vis_dims': 2, 'fig_save_path': params.output_path, 'm': 2}
         results = optimize(X=X.values,
@@ -233,11 +235,11 @@ def run_fcm(paths: List[Dict[str, str]], params):
                            k_values=list(range(2, 10)),
                            goal='minimize')
 
-        results_to_save = generate_results(X, Y, results, results_to_save)
-        results_to_save = generate_results(X, Y, results, results_to_save, fuzzy_eval=True)
+        generate_results(X, Y, results, results_to_save)
+        generate_results(X, Y, results, results_to_save, fuzzy_eval=True)
 
     with open(os.path.join(params.output_path, 'results.md'), 'a') as f:
-        f.write(results_to_save)
+        f.write(''.join(results_to_save))
 
 
 def main(params):
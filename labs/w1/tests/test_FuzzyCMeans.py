@@ -1,6 +1,7 @@
 import pickle
 import unittest
 
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 
@@ -37,6 +38,14 @@ class KMeansTest(unittest.TestCase):
 
         self.assertEqual(loss, expected_loss)
 
+    def test_fuzzy_c_means_memberships_add_up_to_one(self):
+        fcm = FuzzyCMeans(K=3, m=2, name='test', vis_dims=0, seed=self.seed)
+        fcm.fit(self.dataset)
+
+        self.assertEqual(fcm.u.shape, (3, self.dataset.shape[0]))
+        # U is stored in single precision, so columns add up to 1 within a few float32 ulps
+        np.testing.assert_allclose(fcm.u.sum(axis=0), 1, rtol=1e-6)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,12 @@
 import pickle
 import unittest
 
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 
 from algorithms.kmeans import KMeans
+from algorithms.kmodes import KModes
 
 
 class KMeansTest(unittest.TestCase):
@@ -45,6 +47,18 @@ class KMeansTest(unittest.TestCase):
 
         self.assertEqual(predictions, expected_predictions)
 
+    def test_kmodes_with_precomputed_distances(self):
+        dataset = np.round(self.dataset * 3)
+
+        kmodes = KModes(K=3, vis_dims=0, seed=self.seed, name='test')
+        expected_predictions = kmodes.fit_predict(dataset)
+
+        kmodes = KModes(K=3, vis_dims=0, seed=self.seed, name='test')
+        distances = kmodes.compute_point_wise_distances(dataset)
+        predictions = kmodes.fit_predict(dataset, precomputed_distances=distances)
+
+        self.assertEqual(predictions, expected_predictions)
+
 
 if __name__ == '__main__':
     unittest.main()
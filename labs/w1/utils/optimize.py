@@ -5,8 +5,8 @@ import matplotlib.pyplot as plt
 from typing import Type, List
 
 import numpy as np
+from joblib import Parallel, delayed
 from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score, silhouette_score
-from tqdm import tqdm
 
 from algorithms.kmeans import KMeans
 from utils.evaluate import partition_entropy, normalized_partition_coefficient, xie_beni
@@ -46,16 +46,65 @@ def plot_k_metrics(data, alg_name: str, alg_params: dict, metric: str):
 def store_predictions(predictions, alg_name, dataset_name, k, fig_save_path):
     if fig_save_path is not None:
         directory = os.path.join(fig_save_path, alg_name)
-        if not os.path.exists(directory):
-            os.mkdir(directory)
+        os.makedirs(directory, exist_ok=True)
 
         with open(os.path.join(directory, f'prediction_{dataset_name}_K{k}.pkl'), mode='wb') as f:
             pickle.dump(predictions, f)
 
 
+def _fit_one_k(X: np.ndarray, k: int,
+               algorithm: Type[KMeans], algorithm_params: dict, metric: str, metric_params: dict,
+               precomputed_distances: np.ndarray = None, log_file: str = None, log_level=logging.WARNING) -> dict:
+    """
+    Fit the algorithm with a single K value and score it. Run in its own worker by `optimize`.
+    :param log_file: Log file of the parent process, if it logs to one.
+    :param log_level: Logging level of the parent process.
+    :return: Dictionary with K, metric score and predictions obtained.
+    """
+    # Worker processes start with an unconfigured root logger, so they log to the same file as the parent.
+    # Nothing is done if logging is already configured (sequential runs and reused workers)
+    if log_file is not None:
+        logging.basicConfig(filename=log_file, level=log_level)
+        logging.getLogger('matplotlib').setLevel(logging.WARNING)
+
+    logging.info('Optimizing K = %d', k)
+
+    alg = algorithm(K=k, **algorithm_params)
+
+    if metric in ['normalized_partition_coefficient', 'partition_entropy', 'xie_beni']:
+        prediction, v = alg.fit_predict(X)
+        crisp_prediction = alg.crisp_predict(X)
+
+        if metric == 'xie_beni':
+            score = metrics[metric](X=X, u=prediction, centroids=v)
+        else:
+            score = metrics[metric](u=prediction)
+
+        execution = {
+            'k': k,
+            'score': score,
+            'prediction': crisp_prediction,
+            'fuzzy_prediction': prediction,
+            'centroids': v
+        }
+    else:
+        prediction = alg.fit_predict(X, precomputed_distances=precomputed_distances)
+        score = metrics[metric](labels=prediction, **metric_params)
+
+        execution = {
+            'k': k,
+            'score': score,
+            'prediction': prediction
+        }
+
+    store_predictions(prediction, algorithm.__name__, alg.name, k, algorithm_params['fig_save_path'])
+
+    return execution
+
+
 def optimize(X: np.ndarray,
              algorithm: Type[KMeans], algorithm_params: dict, metric: str, metric_params: dict, k_values: List[int],
-             goal: str, precomputed_distances: np.ndarray = None) -> List[dict]:
+             goal: str, precomputed_distances: np.ndarray = None, n_jobs: int = -1) -> List[dict]:
     """
     Optimize K value for the same data, algorithm and metric.
     :param X: 2D data matrix of size (#observations, #features).
@@ -65,50 +114,26 @@ def optimize(X: np.ndarray,
     :param metric_params: Extra parameters for the metric function.
     :param k_values: List of `K` values to test.
     :param goal: `maximize` or `minimize` the metric.
+    :param precomputed_distances: Point-wise distances matrix of X, used by the metric and to fit the algorithm.
+    :param n_jobs: Number of K values fitted in parallel (-1 uses all the cores).
     :return: List sorted from best to worst K value also containing metric score and predictions obtained.
     """
     assert goal in ['maximize', 'minimize']
 
     logging.info(f'Optimizing {algorithm.__name__} with {metric} for K in {k_values}')
 
-    executions = []
-
     if precomputed_distances is not None:
         metric_params['X'] = precomputed_distances
 
-    for k in tqdm(k_values, ncols=100):
-        logging.info(f'Optimizing K = {k}')
-
-        alg = algorithm(K=k, **algorithm_params)
-
-        if metric in ['normalized_partition_coefficient', 'partition_entropy', 'xie_beni']:
-            prediction, v = alg.fit_predict(X)
-            crisp_prediction = alg.crisp_predict(X)
-
-            if metric == 'xie_beni':
-                score = metrics[metric](X=X, u=prediction, centroids=v)
-            else:
-                score = metrics[metric](u=prediction)
-
-            executions.append({
-                'k': k,
-                'score': score,
-                'prediction': crisp_prediction,
-                'fuzzy_prediction': prediction,
-                'centroids': v
-            })
-        else:
-            prediction = alg.fit_predict(X)
-            metric_params['labels'] = prediction
-            score = metrics[metric](**metric_params)
-
-            executions.append({
-                'k': k,
-                'score': score,
-                'prediction': prediction
-            })
+    root_logger = logging.getLogger()
+    log_file = next((h.baseFilename for h in root_logger.handlers if isinstance(h, logging.FileHandler)), None)
 
-        store_predictions(prediction, algorithm.__name__, alg.name, k, algorithm_params['fig_save_path'])
+    # Each K is independent and seeded through `algorithm_params`, so results match a sequential sweep.
+    # joblib reports the progress of the finished fits itself
+    executions = Parallel(n_jobs=n_jobs, backend='loky', verbose=10)(
+        delayed(_fit_one_k)(X, k, algorithm, algorithm_params, metric, metric_params, precomputed_distances,
+                            log_file, root_logger.level)
+        for k in k_values)
 
     plot_k_metrics(executions, algorithm.__name__, algorithm_params, metric)
 
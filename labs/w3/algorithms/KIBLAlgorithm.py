@@ -2,12 +2,16 @@ from collections import Counter
 from typing import List, Tuple, Union
 
 import numpy as np
+from scipy.spatial.distance import cdist
 
 from utils.exceptions import RetentionPolicyException, VotingPolicyException
 
 VOTING_POLICIES = ['MVS', 'MP']
 RETENTION_POLICIES = ['NR', 'AR', 'DF', 'DD']
 
+# Instances whose distances to the training set are computed at once when looking for neighbours in batch
+CHUNK_SIZE = 256
+
 
 class KIBLAlgorithm:
     def __init__(self, K: int, voting_policy: str = 'MVS', retention_policy: str = 'NR', r=2):
@@ -26,17 +30,24 @@ class KIBLAlgorithm:
         self.y = None
 
         self.classes = 0
+        self._labels = None
+        self._y_idx = None
 
     def fit(self, X, y) -> 'KIBLAlgorithm':
         self.X = X
         self.y = y
-        self.classes = len(set(y))
+        # Index of the label of each training instance, so that votes can be counted with np.bincount
+        self._labels, self._y_idx = np.unique(y, return_inverse=True)
+        self.classes = len(self._labels)
         return self
 
     def k_neighbours(self, X: np.ndarray, y: int = None, only_winner=True, return_distances=False) \
             -> Union[List[int], List[Tuple[int, float]]]:
         distances = self.distance_function(self.X, X, self.r)
-        k_nearest_idx = np.argsort(distances)[:self.K]
+        # Select the K nearest in linear time and only sort those
+        K = min(self.K, len(distances))
+        k_nearest_idx = np.argpartition(distances, K - 1)[:K]
+        k_nearest_idx = k_nearest_idx[np.argsort(distances[k_nearest_idx])]
         y_pred = self.__vote(self.y[k_nearest_idx])
 
         self.__apply_retention_policy(X, y, y_pred, self.y[k_nearest_idx])
@@ -49,6 +60,50 @@ class KIBLAlgorithm:
             else:
                 return k_nearest_idx
 
+    def predict(self, X: np.ndarray, y: np.ndarray = None, neighbours: np.ndarray = None) -> np.ndarray:
+        """
+        Predict the labels of a batch of instances.
+        :param X: 2D data array of size (#instances, #features).
+        :param y: Real labels of X, only used by the retention policies.
+        :param neighbours: Optional output of `neighbours` for X with at least K columns, computed with the same
+        training data and r. Ignored by retention policies other than NR.
+        :return: 1D array with the predicted label of each instance.
+        """
+        if self.retention_policy != 'NR':
+            # The case memory may change after each prediction, so instances have to be processed one at a time
+            return np.array([self.k_neighbours(x, y_) for x, y_ in zip(X, y)])
+
+        if neighbours is None:
+            neighbours = self.neighbours(X)
+        return self.__vote_batch(neighbours[:, :self.K])
+
+    def neighbours(self, X: np.ndarray, K: int = None) -> np.ndarray:
+        """
+        Find the nearest training instances of a batch of instances.
+        :param X: 2D data array of size (#instances, #features).
+        :param K: Number of neighbours to return, by default the K of the algorithm.
+        :return: 2D array of size (#instances, K) with the training indexes sorted from nearest to farthest.
+        """
+        K = min(self.K if K is None else K, self.X.shape[0])
+
+        # When r = 2, the training instances in double precision and their squared norms are shared by every chunk
+        X_train, train_sq_norms = self.X, None
+        if self.r == 2:
+            X_train = self.X.astype(np.float64, copy=False)
+            train_sq_norms = (X_train ** 2).sum(axis=1)
+
+        # Only a chunk of the (#instances, #train) distance matrix is alive at a time, keeping its top K
+        neighbours = np.empty((X.shape[0], K), dtype=np.int64)
+        for start in range(0, X.shape[0], CHUNK_SIZE):
+            # Squared distances rank the same as the distances themselves, so the root is skipped when possible
+            distances = self.pairwise_distances(X[start:start + CHUNK_SIZE], X_train, self.r, squared=True,
+                                                v_sq_norms=train_sq_norms)
+            # Select the K nearest of each row in linear time and only sort those
+            nearest = np.argpartition(distances, K - 1, axis=1)[:, :K]
+            order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+            neighbours[start:start + CHUNK_SIZE] = np.take_along_axis(nearest, order, axis=1)
+        return neighbours
+
     def __vote(self, k_most_similar: List[Tuple[int]]):
         counter = Counter(k_most_similar)
         max_occurrence = max(counter.values())
@@ -61,6 +116,36 @@ class KIBLAlgorithm:
             else:
                 return most_common[0]
 
+    def __vote_batch(self, neighbours: np.ndarray) -> np.ndarray:
+        """
+        Same voting as `__vote` for a batch of instances.
+        :param neighbours: 2D array of size (#instances, K) with training indexes sorted from nearest to farthest.
+        :return: 1D array with the voted label of each instance.
+        """
+        labels = self._y_idx[neighbours]
+        n, n_labels = labels.shape[0], len(self._labels)
+
+        # Votes of each label for each instance, counted with a single bincount over offset label indexes
+        votes = np.bincount((np.arange(n)[:, None] * n_labels + labels).ravel(), minlength=n * n_labels)
+        votes = votes.reshape(n, n_labels)
+
+        if self.voting_policy == 'MVS':
+            winners = votes == votes.max(axis=1, keepdims=True)
+            y_pred = np.empty(n, dtype=np.int64)
+            for i, row in enumerate(labels.tolist()):
+                # Break ties at random among the most voted, in order of appearance, as `__vote` does
+                most_common = [label for label in dict.fromkeys(row) if winners[i, label]]
+                y_pred[i] = most_common[np.random.randint(len(most_common))]
+            return self._labels[y_pred]
+        else:
+            # While there is a tie, the vote of the farthest remaining neighbour is discarded
+            for j in range(labels.shape[1] - 1, 0, -1):
+                tied = (votes == votes.max(axis=1, keepdims=True)).sum(axis=1) > 1
+                if not tied.any():
+                    break
+                votes[tied, labels[tied, j]] -= 1
+            return self._labels[votes.argmax(axis=1)]
+
     def __apply_retention_policy(self, X: np.ndarray, y: int, y_pred: int, k_nearest: np.ndarray):
         if self.retention_policy == 'AR':
             self.X = np.vstack((self.X, X))
@@ -82,3 +167,31 @@ class KIBLAlgorithm:
     @staticmethod
     def distance_function(u: np.ndarray, v: np.ndarray, r: int, axis=1):
         return np.linalg.norm(u - v, axis=axis, ord=r)
+
+    @staticmethod
+    def pairwise_distances(u: np.ndarray, v: np.ndarray, r: int, squared=False, v_sq_norms: np.ndarray = None) \
+            -> np.ndarray:
+        """
+        Minkowski distances between every pair of instances of u and v.
+        :param squared: Whether squared euclidean distances are enough when r = 2, which avoids the square root.
+        Other orders always return the distances themselves.
+        :param v_sq_norms: Optional squared norms of the instances of v in double precision, only used when r = 2.
+        :return: Distance matrix of size (#instances u, #instances v).
+        """
+        if r == 2:
+            # A single matrix product using ||x - y|| ^ 2 = ||x|| ^ 2 + ||y|| ^ 2 - 2 * x · y, in double precision,
+            # since the cancellation error of single precision is as large as the distances between near duplicates
+            u = u.astype(np.float64, copy=False)
+            v = v.astype(np.float64, copy=False)
+            if v_sq_norms is None:
+                v_sq_norms = (v ** 2).sum(axis=1)
+            distances = u @ v.T
+            distances *= -2
+            distances += (u ** 2).sum(axis=1)[:, None]
+            distances += v_sq_norms[None, :]
+            np.maximum(distances, 0, out=distances)
+            return distances if squared else np.sqrt(distances, out=distances)
+        # Use the dedicated kernel of r = 1 instead of the generic power-based Minkowski one
+        if r == 1:
+            return cdist(u, v, metric='cityblock')
+        return cdist(u, v, metric='minkowski', p=r)
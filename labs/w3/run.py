@@ -1,14 +1,14 @@
 import argparse
+import hashlib
 import json
 import logging
 import multiprocessing
 import os
-import pickle
-from copy import deepcopy
-from multiprocessing.pool import ThreadPool
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Pool
 from time import time
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 from scipy.stats import wilcoxon, ttest_ind
@@ -18,7 +18,7 @@ from algorithms.KIBLAlgorithm import KIBLAlgorithm, VOTING_POLICIES, RETENTION_P
 from algorithms.reduction_KIBL_algorithm import reduction_KIBL_algorithm, REDUCTION_METHODS
 from preprocessing.hypothyroid import preprocess as preprocess_hypothyroid
 from preprocessing.pen_based import preprocess as preprocess_penn
-from utils.dataset import read_dataset
+from utils.dataset import read_dataset, read_results
 from utils.exceptions import TestMethodException
 
 import matplotlib.patches as mpatches
@@ -28,113 +28,143 @@ from math import sqrt
 import matplotlib.pyplot as plt
 
 OUTPUT_PATH = 'output'
+REDUCED_PATH = os.path.join(OUTPUT_PATH, 'reduced')
 
 K_VALUES = [1, 3, 5, 7]
 R_VALUES = [1, 2, 3]
 
 TEST_METHODS = ['anova', 'wilcoxon', 'ttest']
 
+# Folds of the worker processes, sent once when the pool starts instead of with every task
+_worker_folds = None
 
-def read_data(name: str) -> List[dict]:
-    folds = []
+
+def _init_worker(folds: List[dict]):
+    global _worker_folds
+    _worker_folds = folds
+
+
+def read_fold(name: str, i: int) -> dict:
     preprocess = preprocess_hypothyroid if name == 'hypothyroid' else preprocess_penn
 
-    for i in tqdm(range(10), desc=f'Reading {name} dataset', ncols=150):
-        train_data = read_dataset(name=f'{name}.fold.00000{i}.train', dataset_path=os.path.join('datasets', name))
-        validation_data = read_dataset(name=f'{name}.fold.00000{i}.test', dataset_path=os.path.join('datasets', name))
-        (X_train, y_train), (X_val, y_val) = preprocess(train_data, validation_data)
-        folds.append({
-            'X_train': X_train,
-            'y_train': y_train,
-            'X_val': X_val,
-            'y_val': y_val
-        })
+    train_data = read_dataset(name=f'{name}.fold.00000{i}.train', dataset_path=os.path.join('datasets', name))
+    validation_data = read_dataset(name=f'{name}.fold.00000{i}.test', dataset_path=os.path.join('datasets', name))
+    (X_train, y_train), (X_val, y_val) = preprocess(train_data, validation_data)
+    # Contiguous numeric arrays with a fixed dtype, ready for the vectorized distance computations
+    return {
+        'X_train': np.ascontiguousarray(X_train, dtype=np.float32),
+        'y_train': np.ascontiguousarray(y_train, dtype=np.int32),
+        'X_val': np.ascontiguousarray(X_val, dtype=np.float32),
+        'y_val': np.ascontiguousarray(y_val, dtype=np.int32)
+    }
+
+
+def read_data(name: str) -> List[dict]:
+    # Reading is mostly I/O and parsing, so the folds are loaded concurrently
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        folds = list(tqdm(executor.map(lambda i: read_fold(name, i), range(10)),
+                          total=10, desc=f'Reading {name} dataset', ncols=150))
 
     return folds
 
 
-def run_knn_fold(fold: dict, config: dict, seed: int, i=None, lock=None):
+def run_knn_fold(fold: dict, config: dict, seed: int, i=None, neighbours=None, neighbours_time=0.):
     np.random.seed(seed)
-    time_start = time()
+    # The time of a neighbour search shared between configurations is added, so every configuration pays for it
+    time_start = time() - neighbours_time
 
     alg = KIBLAlgorithm(**config)
     alg.fit(fold['X_train'], fold['y_train'])
-    val_data = list(zip(fold['X_val'], fold['y_val']))
-
-    if lock is not None:
-        with lock:
-            t_val = tqdm(total=len(val_data), desc=f'Fold {i:2}', ncols=150, position=i)
-    else:
-        t_val = tqdm(total=len(val_data), desc=f'Fold {i:2}', ncols=150)
-
-    corrects = 0
-    for X, y in val_data:
-        prediction = alg.k_neighbours(X, y)
-        if prediction == y:
-            corrects += 1
 
-        if lock is not None:
-            with lock:
-                t_val.update()
-        else:
-            t_val.update()
-
-    if lock is not None:
-        with lock:
-            t_val.close()
-    else:
-        t_val.close()
+    predictions = alg.predict(fold['X_val'], fold['y_val'], neighbours=neighbours)
+    corrects = int(np.sum(predictions == fold['y_val']))
 
     return i, {
-        'accuracy': corrects / len(val_data),
+        'accuracy': corrects / len(fold['y_val']),
         'time': time() - time_start
     }
 
 
+def find_neighbours(fold: dict, r: int) -> Tuple[np.ndarray, float]:
+    time_start = time()
+    alg = KIBLAlgorithm(K=max(K_VALUES), r=r).fit(fold['X_train'], fold['y_train'])
+    return alg.neighbours(fold['X_val']), time() - time_start
+
+
+def get_fold_neighbours(neighbours: dict, config: dict, i: int) -> Tuple[np.ndarray, float]:
+    # Other retention policies modify the case memory and search their own neighbours
+    return neighbours[config['r']][i] if config['retention_policy'] == 'NR' else (None, 0.)
+
+
+def _find_neighbours_worker(i: int, r: int) -> Tuple[np.ndarray, float]:
+    return find_neighbours(_worker_folds[i], r)
+
+
+def _run_knn_fold_worker(config: dict, seed: int, i: int, neighbours=None, neighbours_time=0.):
+    return run_knn_fold(_worker_folds[i], config, seed, i, neighbours, neighbours_time)
+
+
 def run_kIBL(folds, name, seed, par):
     i_experiment = 0
     n_experiments = len(K_VALUES) * len(VOTING_POLICIES) * len(RETENTION_POLICIES) * len(R_VALUES)
 
-    results = []
-    for k in K_VALUES:
-        for r in R_VALUES:
-            for voting_policy in VOTING_POLICIES:
-                for retention_policy in RETENTION_POLICIES:
-                    config = {'K': k, 'r': r, 'voting_policy': voting_policy, 'retention_policy': retention_policy}
-
-                    i_experiment += 1
-                    print('-' * 150)
-                    print(f'> Running experiment ({i_experiment}/{n_experiments}): '
-                          f'K={k}, r={r}, VP={voting_policy} and RP={retention_policy}' + ' ' * 100)
-
-                    if par:
-                        cores = min(multiprocessing.cpu_count(), 5)
-                        pool = ThreadPool(cores)
-                        lock = Lock()
-
-                        fold_results = {}
-                        for i, fold in enumerate(folds):
-                            pool.apply_async(run_knn_fold, args=(fold, config, seed, i, lock),
-                                             callback=lambda x: fold_results.update({x[0]: x[1]}))
-
-                        pool.close()
-                        pool.join()
-
-                        fold_results = [fold_results[f] for f in range(len(folds))]
-                    else:
-                        fold_results = list(map(lambda x: run_knn_fold(x[1], config, seed, x[0]), enumerate(folds)))
-
-                    results.append({
-                        'k': k,
-                        'r': r,
-                        'vp': voting_policy,
-                        'rp': retention_policy,
-                        'results': fold_results
-                    })
-
-    results_json = json.dumps(results)
-    with open(os.path.join(OUTPUT_PATH, name + '_results.json'), mode='w') as f:
-        f.write(results_json)
+    with ExitStack() as stack:
+        if par:
+            # Processes instead of threads, since the prediction of a fold holds the GIL. A single pool is reused
+            # by every configuration, and the folds are sent to its workers only once
+            cores = min(multiprocessing.cpu_count(), len(folds))
+            pool = stack.enter_context(Pool(cores, initializer=_init_worker, initargs=(folds,)))
+
+        # Neighbours only depend on the fold and r, so they are found once and shared by every K and VP of NR,
+        # together with the time spent finding them
+        print('> Finding nearest neighbours of each fold...')
+        searches = [(i, r) for r in R_VALUES for i in range(len(folds))]
+        if par:
+            found = pool.starmap(_find_neighbours_worker, searches)
+        else:
+            found = [find_neighbours(folds[i], r) for i, r in searches]
+        neighbours = {r: [] for r in R_VALUES}
+        for (_, r), fold_neighbours in zip(searches, found):
+            neighbours[r].append(fold_neighbours)
+
+        # Each configuration is written as a JSON line as soon as it finishes, so partial sweeps are kept
+        f = stack.enter_context(open(os.path.join(OUTPUT_PATH, name + '_results.jsonl'), mode='w'))
+
+        for k in K_VALUES:
+            for r in R_VALUES:
+                for voting_policy in VOTING_POLICIES:
+                    for retention_policy in RETENTION_POLICIES:
+                        config = {'K': k, 'r': r, 'voting_policy': voting_policy, 'retention_policy': retention_policy}
+
+                        i_experiment += 1
+                        print('-' * 150)
+                        print(f'> Running experiment ({i_experiment}/{n_experiments}): '
+                              f'K={k}, r={r}, VP={voting_policy} and RP={retention_policy}' + ' ' * 100)
+
+                        t_folds = tqdm(total=len(folds), desc='Folds', ncols=150)
+                        if par:
+                            fold_results = [pool.apply_async(_run_knn_fold_worker,
+                                                             args=(config, seed, i,
+                                                                   *get_fold_neighbours(neighbours, config, i)),
+                                                             callback=lambda _: t_folds.update())
+                                            for i in range(len(folds))]
+                            fold_results = [result.get()[1] for result in fold_results]
+                        else:
+                            fold_results = []
+                            for i, fold in enumerate(folds):
+                                fold_neighbours = get_fold_neighbours(neighbours, config, i)
+                                fold_results.append(run_knn_fold(fold, config, seed, i, *fold_neighbours)[1])
+                                t_folds.update()
+                        t_folds.close()
+
+                        f.write(json.dumps({
+                            'k': k,
+                            'r': r,
+                            'vp': voting_policy,
+                            'rp': retention_policy,
+                            'results': fold_results
+                        }) + '\n')
+                        f.flush()
 
 
 def compute_stat_test(sample1, sample2, test):
@@ -154,97 +184,91 @@ def compute_stat_test(sample1, sample2, test):
     return {'stat': stat, 'p': p}
 
 
-def eval_stat_test(mat, results, test, alpha=0.05):
+def compute_pairwise_stat_tests(samples: np.ndarray, test: str) -> np.ndarray:
+    """
+    Run the statistical test between every pair of models.
+    :param samples: 2D array of size (#models, #folds) with the measure obtained by each model in each fold.
+    :param test: Statistical test to use.
+    :return: 3D array of size (#models, #models, 2) with the statistic and p-value of each pair (NaN for i == j).
+    """
     if test not in TEST_METHODS:
         raise TestMethodException()
 
-    select_mat = np.zeros(mat.shape[:-1])
     if test == 'anova':
         raise NotImplementedError()
-    elif test == 'wilcoxon':
-        for i in range(mat.shape[0]):
-            for j in range(mat.shape[1]):
-                statistic = mat[i][j][0]
-                p_value = mat[i][j][1]
-                if p_value < alpha:  # significant
-                    if statistic > 0:  # second is better
-                        mean_acc1 = np.mean(list(map(lambda x: x['accuracy'], results[i]['results'])))
-                        mean_acc2 = np.mean(list(map(lambda x: x['accuracy'], results[j]['results'])))
-                        if mean_acc1 > mean_acc2:  # first is better
-                            select_mat[i][j] = 1
-                        elif mean_acc1 < mean_acc2:  # second is better
-                            select_mat[i][j] = 2
-                        else:  # tie
-                            select_mat[i][j] = 0
-                        select_mat[i][j] = 2
-                    else:  # tie
-                        select_mat[i][j] = 0
-                else:  # tie
-                    select_mat[i][j] = 0
+
+    # Both tests give the same p-value when swapping the samples, so only pairs i < j are tested and mirrored
+    i_idx, j_idx = np.triu_indices(len(samples), k=1)
+    stats = np.full(shape=(len(samples), len(samples), 2), fill_value=np.nan)
+
+    if test == 'ttest':
+        # ttest_ind is vectorized over the leading axis, so all the pairs are tested in a single call
+        stat, p = ttest_ind(samples[i_idx], samples[j_idx], axis=-1)
+        stats[i_idx, j_idx] = np.stack([stat, p], axis=-1)
+        # Swapping the samples flips the sign of the t statistic
+        stats[j_idx, i_idx] = np.stack([-stat, p], axis=-1)
     else:
-        for i in range(mat.shape[0]):
-            for j in range(mat.shape[1]):
-                statistic = mat[i][j][0]
-                p_value = mat[i][j][1]
-                if p_value < alpha:  # significant
-                    if statistic < 0:  # second is better
-                        select_mat[i][j] = 2
-                    elif statistic > 0:  # first is better
-                        select_mat[i][j] = 1
-                    else:  # tie
-                        select_mat[i][j] = 0
-                else:  # tie
-                    select_mat[i][j] = 0
-    return select_mat
+        # wilcoxon only accepts 1D samples. Its statistic (smallest rank sum) does not change when swapping them
+        for i, j in zip(i_idx, j_idx):
+            stat = compute_stat_test(samples[i], samples[j], test)
+            stats[i, j] = stats[j, i] = [stat['stat'], stat['p']]
 
+    return stats
 
-def combine_test(select_mat_acc, select_mat_time):
-    combine_mat = np.zeros(select_mat_acc.shape)
-    for i in range(select_mat_acc.shape[0]):
-        for j in range(select_mat_acc.shape[1]):
-            if select_mat_acc[i, j] == 1:
-                combine_mat[i, j] = 1
-            elif select_mat_acc[i, j] == 2:
-                combine_mat[i, j] = 2
-            elif select_mat_time[i, j] == 1:
-                combine_mat[i, j] = 2
-            elif select_mat_time[i, j] == 2:
-                combine_mat[i, j] = 1
-    return combine_mat
-
-
-def run_stat_select_kIBL(kIBL_json_path, name, test):
+
+def eval_stat_test(mat, mean_accs, test, alpha=0.05):
     if test not in TEST_METHODS:
         raise TestMethodException()
 
     if test == 'anova':
         raise NotImplementedError()
 
-    results = json.loads(open(kIBL_json_path, 'r').read())
-    stats_accuracy = np.full(shape=(len(results), len(results), 2), fill_value=np.nan)
-    stats_time = np.full(shape=(len(results), len(results), 2), fill_value=np.nan)
+    statistic, p_value = mat[..., 0], mat[..., 1]
+    # NaN entries (a model against itself) are never significant
+    with np.errstate(invalid='ignore'):
+        significant = p_value < alpha
+        if test == 'wilcoxon':
+            # The statistic does not tell which model is better, so it is decided with the mean accuracies
+            first_better = significant & (statistic > 0) & (mean_accs[:, None] > mean_accs[None, :])
+            second_better = significant & (statistic > 0) & (mean_accs[:, None] < mean_accs[None, :])
+        else:
+            first_better = significant & (statistic > 0)
+            second_better = significant & (statistic < 0)
 
-    for i, model1 in enumerate(results):
-        for j, model2 in enumerate(results):
-            if model1 == model2:
-                continue
-            res1_acc = list(map(lambda x: x['accuracy'], model1['results']))
-            res2_acc = list(map(lambda x: x['accuracy'], model2['results']))
+    # 1 if the first (i) is better, 2 if the second (j) is better and 0 if tie
+    select_mat = np.zeros(mat.shape[:-1])
+    select_mat[first_better] = 1
+    select_mat[second_better] = 2
+    return select_mat
+
+
+def combine_test(select_mat_acc, select_mat_time):
+    # Accuracy decides first, and the execution time breaks its ties (the fastest model wins)
+    return np.select([select_mat_acc == 1, select_mat_acc == 2, select_mat_time == 1, select_mat_time == 2],
+                     [1, 2, 2, 1], default=0).astype(np.float64)
+
+
+def run_stat_select_kIBL(name, test):
+    if test not in TEST_METHODS:
+        raise TestMethodException()
 
-            res1_time = list(map(lambda x: x['time'], model1['results']))
-            res2_time = list(map(lambda x: x['time'], model2['results']))
+    if test == 'anova':
+        raise NotImplementedError()
 
-            stat_accuracy = compute_stat_test(res1_acc, res2_acc, test)
-            stat_time = compute_stat_test(res1_time, res2_time, test)
+    results = read_results(name, output_path=OUTPUT_PATH)
+    accuracies = np.array([[x['accuracy'] for x in model['results']] for model in results])
+    times = np.array([[x['time'] for x in model['results']] for model in results])
 
-            stats_accuracy[i, j] = np.array([stat_accuracy['stat'], stat_accuracy['p']])
-            stats_time[i, j] = np.array([stat_accuracy['stat'], stat_time['p']])
+    stats_accuracy = compute_pairwise_stat_tests(accuracies, test)
+    stats_time = compute_pairwise_stat_tests(times, test)
 
-    pickle.dump(stats_accuracy, open(os.path.join(OUTPUT_PATH, name + '_accuracy.pkl'), mode='wb'))
-    pickle.dump(stats_time, open(os.path.join(OUTPUT_PATH, name + '_time.pkl'), mode='wb'))
+    # Raw .npy files, which can be loaded back with np.load(..., mmap_mode='r')
+    np.save(os.path.join(OUTPUT_PATH, name + '_accuracy.npy'), stats_accuracy)
+    np.save(os.path.join(OUTPUT_PATH, name + '_time.npy'), stats_time)
 
-    select_mat_acc = eval_stat_test(stats_accuracy, results, test=test)
-    select_mat_time = eval_stat_test(stats_time, results, test=test)
+    mean_accs = accuracies.mean(axis=1)
+    select_mat_acc = eval_stat_test(stats_accuracy, mean_accs, test=test)
+    select_mat_time = eval_stat_test(stats_time, mean_accs, test=test)
 
     # combine_mat = combine_test(select_mat_acc, select_mat_time)
 
@@ -287,56 +311,82 @@ def run_stat_select_kIBL(kIBL_json_path, name, test):
     # print('Best index', np.argwhere(np.amax(np.sum(combine_mat == 2, axis=0)) == (np.sum(combine_mat == 1, axis=0))), 'with', np.max(np.sum(combine_mat == 1, axis=0)), 'wins')
 
 
-def run_reduction_kIBL_fold(fold, method, config, seed, i=None, lock=None):
-    reduced_fold = deepcopy(fold)
-
+def run_reduction_kIBL_fold(fold, name, method, config, seed, i=None):
     time_start = time()
 
-    reduced_fold['X_train'], reduced_fold['y_train'] = \
-        reduction_KIBL_algorithm(config, fold['X_train'], fold['y_train'], method, seed)
-
-    print(f'Train fold reduced from {len(fold["X_train"])} to {len(reduced_fold["X_train"])} instances '
-          f'(elapsed time {time() - time_start:.5f}s)')
-
-    result = run_knn_fold(reduced_fold, config, seed, i, lock)
+    # Validation data is not modified, so it is shared with the original fold instead of copied
+    reduced_fold = {'X_val': fold['X_val'], 'y_val': fold['y_val']}
+
+    # Reductions are expensive and deterministic given the seed and the training data, so seeded runs store them
+    # to be reused. Unseeded runs are random and always reduce again
+    cache_path = None
+    if seed is not None:
+        data_hash = hashlib.sha1(fold['X_train'].tobytes() + fold['y_train'].tobytes()).hexdigest()[:12]
+        cache_path = os.path.join(REDUCED_PATH,
+                                  f'{name}_{method}_K{config["K"]}_r{config["r"]}_seed{seed}_{data_hash}.npz')
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as reduced:
+            reduced_fold['X_train'], reduced_fold['y_train'] = reduced['X'], reduced['y']
+        print(f'Train fold reduced from {len(fold["X_train"])} to {len(reduced_fold["X_train"])} instances '
+              f'(loaded from {cache_path})')
+    else:
+        reduced_fold['X_train'], reduced_fold['y_train'] = \
+            reduction_KIBL_algorithm(config, fold['X_train'], fold['y_train'], method, seed)
+        print(f'Train fold reduced from {len(fold["X_train"])} to {len(reduced_fold["X_train"])} instances '
+              f'(elapsed time {time() - time_start:.5f}s)')
+        if cache_path is not None:
+            # Written under a temporary name and moved atomically, so an interrupted run leaves no truncated file
+            tmp_path = f'{cache_path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_path, X=reduced_fold['X_train'], y=reduced_fold['y_train'])
+            os.replace(tmp_path, cache_path)
+
+    result = run_knn_fold(reduced_fold, config, seed, i)
     result[1]['new_dim'] = reduced_fold['X_train'].shape[0]
     result[1]['old_dim'] = fold['X_train'].shape[0]
     return result
 
 
+def _run_reduction_kIBL_fold_worker(name, method, config, seed, i):
+    return run_reduction_kIBL_fold(_worker_folds[i], name, method, config, seed, i)
+
+
 def run_reduction_kIBL(folds, name, seed, par):
     config = {'K': 5, 'r': 1}
-    results = []
-    for i_experiment, method in enumerate(REDUCTION_METHODS):
-        print('-' * 150)
-        print(f'> Running experiment ({i_experiment + 1}/{len(REDUCTION_METHODS)}): {method}' + ' ' * 100)
+    os.makedirs(REDUCED_PATH, exist_ok=True)
 
+    results = []
+    with ExitStack() as stack:
         if par:
-            cores = min(multiprocessing.cpu_count(), 5)
-            pool = ThreadPool(cores)
-            lock = Lock()
-
-            fold_results = {}
-            for i, fold in enumerate(folds):
-                pool.apply_async(run_reduction_kIBL_fold, args=(fold, method, config, seed, i, lock),
-                                 callback=lambda x: fold_results.update({x[0]: x[1]}))
-
-            pool.close()
-            pool.join()
-
-            fold_results = [fold_results[f] for f in range(len(folds))]
-        else:
-            fold_results = list(
-                map(lambda x: run_reduction_kIBL_fold(x[1], method, config, seed, x[0])[1], enumerate(folds)))
-
-        results.append({
-            'method': method,
-            'results': fold_results
-        })
+            # A single pool is reused by every method, and the folds are sent to its workers only once
+            cores = min(multiprocessing.cpu_count(), len(folds))
+            pool = stack.enter_context(Pool(cores, initializer=_init_worker, initargs=(folds,)))
+
+        for i_experiment, method in enumerate(REDUCTION_METHODS):
+            print('-' * 150)
+            print(f'> Running experiment ({i_experiment + 1}/{len(REDUCTION_METHODS)}): {method}' + ' ' * 100)
+
+            t_folds = tqdm(total=len(folds), desc='Folds', ncols=150)
+            if par:
+                fold_results = [pool.apply_async(_run_reduction_kIBL_fold_worker,
+                                                 args=(name, method, config, seed, i),
+                                                 callback=lambda _: t_folds.update())
+                                for i in range(len(folds))]
+                fold_results = [result.get()[1] for result in fold_results]
+            else:
+                fold_results = []
+                for i, fold in enumerate(folds):
+                    fold_results.append(run_reduction_kIBL_fold(fold, name, method, config, seed, i)[1])
+                    t_folds.update()
+            t_folds.close()
+
+            results.append({
+                'method': method,
+                'results': fold_results
+            })
 
-    results_json = json.dumps(results)
     with open(os.path.join(OUTPUT_PATH, name + '_reduction.json'), mode='w') as f:
-        f.write(results_json)
+        json.dump(results, f)
 
 
 if __name__ == '__main__':
@@ -365,8 +415,7 @@ if __name__ == '__main__':
         data = read_data(args.dataset)
         run_kIBL(folds=data, name=args.dataset, seed=args.seed, par=args.par)
     elif args.algorithm == 'stat':
-        run_stat_select_kIBL(kIBL_json_path=os.path.join('output', f'{args.dataset}_results.json'), name=args.dataset,
-                             test='ttest')
+        run_stat_select_kIBL(name=args.dataset, test='ttest')
     else:
         data = read_data(args.dataset)
         run_reduction_kIBL(folds=data, name=args.dataset, seed=args.seed, par=args.par)
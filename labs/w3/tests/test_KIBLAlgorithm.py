@@ -0,0 +1,35 @@
+import unittest
+
+import numpy as np
+
+from algorithms.KIBLAlgorithm import KIBLAlgorithm, VOTING_POLICIES
+
+
+class KIBLAlgorithmTest(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        # Few classes and an even K, so that many votes end up tied
+        self.X_train = random_state.rand(60, 4)
+        self.y_train = random_state.randint(3, size=60)
+        self.X_val = random_state.rand(40, 4)
+
+        self.seed = 42
+
+    def test_batch_predictions_match_sequential_predictions(self):
+        for voting_policy in VOTING_POLICIES:
+            for r in [1, 2, 3]:
+                with self.subTest(voting_policy=voting_policy, r=r):
+                    alg = KIBLAlgorithm(K=4, voting_policy=voting_policy, r=r).fit(self.X_train, self.y_train)
+
+                    np.random.seed(self.seed)
+                    expected_predictions = [alg.k_neighbours(x) for x in self.X_val]
+
+                    np.random.seed(self.seed)
+                    predictions = alg.predict(self.X_val)
+
+                    self.assertEqual(predictions.tolist(), expected_predictions)
+
+
+if __name__ == '__main__':
+    unittest.main()
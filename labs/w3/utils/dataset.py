@@ -1,3 +1,4 @@
+import json
 from glob import glob
 
 import os
@@ -37,6 +38,23 @@ def read_dataset(name=None, dataset_path='datasets', verbose=False, ):
         return datasets
 
 
+def read_results(name, output_path='output'):
+    """
+    Read the results of the kIBL experiments of a dataset.
+    :param name: Name of the dataset.
+    :param output_path: Folder where the results were stored.
+    :return: List with the results of each configuration.
+    """
+    path = os.path.join(output_path, f'{name}_results.jsonl')
+    if os.path.exists(path):
+        with open(path, mode='r') as f:
+            return [json.loads(line) for line in f]
+
+    # Older runs stored all the results as a single JSON list
+    with open(os.path.join(output_path, f'{name}_results.json'), mode='r') as f:
+        return json.load(f)
+
+
 def filter_datasets_by_attributes_type(dataset, tp):
     assert tp in ['numeric', 'nominal', 'mix']
 
@@ -1,10 +1,12 @@
-import json
 import matplotlib.pyplot as plt
 
 import os
 
 import numpy as np
 
+from dataset import read_results
+
+
 def color_from_rp(rp):
     color = '#ffff00'
     if rp == 'NR':
@@ -29,8 +31,7 @@ def marker_from_vp(vp):
 def visualize(dataset: str):
     assert dataset in ['hypothyroid', 'pen-based'], 'dataset must be "hypothyroid" or "pen-based"'
 
-    with open(os.path.join('../output', f'{dataset}_results.json'), mode='r') as f:
-        data = json.loads(f.read())
+    data = read_results(dataset, output_path='../output')
 
     dataset_name = 'Hypothyroid'
     if dataset == 'pen-based':
@@ -60,8 +61,7 @@ def visualize(dataset: str):
 def visualize_all(dataset: str):
     assert dataset in ['hypothyroid', 'pen-based'], 'dataset must be "hypothyroid" or "pen-based"'
 
-    with open(os.path.join('../output', f'{dataset}_results.json'), mode='r') as f:
-        data = json.loads(f.read())
+    data = read_results(dataset, output_path='../output')
 
     dataset_name = 'Hypothyroid'
     if dataset == 'pen-based':